@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+
+# Converts config.jsonc into a plain python module (config.py), which
+# cpu_temps.py imports instead of parsing the jsonc on every start.
+# Rerun this after editing config.jsonc, until then cpu_temps.py ignores
+# the outdated config.py and parses config.jsonc again.
+
+import os
+import pprint
+import json5
+
+config_dir = os.path.dirname(os.path.abspath(__file__))
+
+with open(os.path.join(config_dir, "config.jsonc")) as cf:
+    config = json5.load(cf)
+
+with open(os.path.join(config_dir, "config.py"), "w") as f:
+    f.write("# generated from config.jsonc by compile_config.py, don't edit\n")
+    f.write("config = " + pprint.pformat(config, sort_dicts=False) + "\n")
@@ -1,52 +1,152 @@
 #!/usr/bin/env python3
 
-# Uses the `sensors` linux utility to get the current CPU temperature
-# and reports it to an InfluxDB server
+# Reads the current CPU temperature from sysfs (or the `sensors` linux
+# utility as a fallback) and reports it to an InfluxDB server
 # initially based on:
 # https://mansfield-devine.com/speculatrix/2021/08/network-monitoring-2-logging-cpu-temps-with-influxdb-and-grafana/
 # https://pypi.org/project/influxdb-client/#connect-to-influxdb-cloud
 
 import os
 import sys
-from urllib3.exceptions import HTTPError
+import asyncio
 import random
-import datetime
+import signal
+import glob
 from socket import gethostname
-import subprocess
-import json5
+import json
 import time
-from influxdb_client import InfluxDBClient, Point
-from influxdb_client.client.exceptions import InfluxDBError
-from influxdb_client.client.write_api import SYNCHRONOUS
+import http.client
+from urllib.parse import urlsplit, urlencode
+from concurrent.futures import ThreadPoolExecutor
 
 app_name = "cpu_temps"  # used for logging
 log_file = None
+# opened once, stays None (meaning stderr) until the config is loaded
+log_fh = None
+# samples waiting to be written while influxdb is slow or unreachable,
+# beyond this newer samples are dropped
+max_queued_points = 10_000
+# in seconds, how long pending samples may take to write before disconnecting
+flush_timeout = 5
+# in seconds, for connecting to and waiting on the influxdb
+http_timeout = 10
+# used for the backoff exponent and jitter, avoids going through the
+# module level random instance
+rng = random.Random()
+
+# hwmon driver names that expose the cpu package temperature as temp1_input
+hwmon_cpu_drivers = ("coretemp", "k10temp", "zenpower", "cpu_thermal")
+# thermal zone types that report the cpu temperature
+thermal_zone_cpu_types = ("x86_pkg_temp", "cpu-thermal", "cpu_thermal")
+
+
+# the formatted timestamp only changes once per second
+last_time_str_sec = None
+last_time_str = None
 
 
 def time_str():
-    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    global last_time_str_sec, last_time_str
+    now = int(time.time())
+    if now != last_time_str_sec:
+        last_time_str_sec = now
+        last_time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now))
+    return last_time_str
 
 
 def log(message):
-    message = time_str() + " " + message + "\n"
+    (log_fh or sys.stderr).write(time_str() + " " + message + "\n")
+
+
+# also used on SIGHUP, so logrotate can move the log file away
+def reopen_log():
+    global log_fh
+    if log_fh is not None and log_fh is not sys.stderr:
+        log_fh.close()
+        log_fh = None
     if log_file is None:
-        sys.stderr.write(message)
+        log_fh = sys.stderr
     else:
-        with open(log_file, "a+") as log:
-            log.write(message)
+        # line buffered, so every message reaches the file immediately
+        log_fh = open(log_file, "a", buffering=1)
+
+
+# registered with the event loop in main, so it never runs in the middle
+# of a log() call
+def on_sighup():
+    try:
+        reopen_log()
+    except OSError as ex:
+        log(f"failed to reopen log file {log_file}: {str(ex)}")
+
+
+def find_sysfs_temp_path():
+    for hwmon in sorted(glob.glob("/sys/class/hwmon/hwmon*")):
+        try:
+            with open(os.path.join(hwmon, "name")) as f:
+                name = f.read().strip()
+        except OSError:
+            continue
+        temp_path = os.path.join(hwmon, "temp1_input")
+        if name in hwmon_cpu_drivers and os.path.exists(temp_path):
+            return temp_path
+    for zone in sorted(glob.glob("/sys/class/thermal/thermal_zone*")):
+        try:
+            with open(os.path.join(zone, "type")) as f:
+                zone_type = f.read().strip()
+        except OSError:
+            continue
+        if zone_type in thermal_zone_cpu_types:
+            return os.path.join(zone, "temp")
+    return None
+
+
+def lp_escape(s, special=",= "):
+    # escapes the characters that are special in line protocol identifiers
+    for c in special:
+        s = s.replace(c, "\\" + c)
+    return s
+
+
+# config.py is generated by compile_config.py and is only used
+# if it is at least as recent as config.jsonc
+def config_is_compiled():
+    try:
+        compiled_mtime = os.path.getmtime(compiled_config_path)
+    except OSError:
+        return False
+    try:
+        return compiled_mtime >= os.path.getmtime(log_file_path)
+    except OSError:
+        return True
 
 
 # load and parse config
 log_file_path = os.path.join(os.path.dirname(__file__), "config.jsonc")
+compiled_config_path = os.path.join(os.path.dirname(__file__), "config.py")
 try:
-    with open(log_file_path) as cf:
-        config = json5.load(cf)
+    if config_is_compiled():
+        from config import config
+    else:
+        # json5 is slow to import and parse, so it's only used if needed
+        import json5
+        with open(log_file_path) as cf:
+            config = json5.load(cf)
 
     log_file = config["log_file"]
+    try:
+        reopen_log()
+    except OSError as ex:
+        log(f"failed to open log file {log_file}: {str(ex)}")
+        exit(1)
     server_name = config["server_name"]
     if server_name is None:
         server_name = gethostname()
-    influx_url = config["influx_url"]
+    influx_url = urlsplit(config["influx_url"])
+    if influx_url.scheme not in ("http", "https") or not influx_url.hostname:
+        raise ValueError(f"invalid influx_url '{config['influx_url']}'")
+    # raises ValueError for an invalid port
+    influx_port = influx_url.port
     influx_org = config["influx_org"]
     influx_token = config["influx_token"]
     influx_bucket = config["influx_bucket"]
@@ -57,7 +157,37 @@ try:
 
     interval = float(config["interval"])
     back_off_max_interval = float(config["back_off_max_interval"])
+    # while the temperature stays within min_delta_c of the last submitted
+    # value, the polling interval grows up to idle_backoff_max_interval.
+    # 0 disables this and submits every sample
+    min_delta_c = float(config.get("min_delta_c", 0))
+    # clamped, so a stable temperature never polls faster than interval
+    idle_backoff_factor = max(
+        1.0, float(config.get("idle_backoff_factor", 1.5))
+    )
+    idle_backoff_max_interval = max(
+        interval, float(config.get("idle_backoff_max_interval", interval))
+    )
+    max_idle_writes = int(config.get("max_idle_writes", 0))
+    # samples are written once batch_size of them have been collected, or
+    # max_batch_age seconds after the oldest one was taken
+    batch_size = max(int(config.get("batch_size", 1)), 1)
+    max_batch_age = float(config.get("max_batch_age", 0))
+    # null means leave the scheduling of this process alone
+    pin_cpu = config.get("pin_cpu")
+    if pin_cpu is not None:
+        pin_cpu = int(pin_cpu)
+    nice_level = config.get("nice_level")
+    if nice_level is not None:
+        nice_level = int(nice_level)
     temp_access_path = config["temp_access_path"]
+    # null (or missing) means use `sensors -j` with temp_access_path
+    temp_sysfs_path = config.get("temp_sysfs_path")
+    if temp_sysfs_path == "auto":
+        temp_sysfs_path = find_sysfs_temp_path()
+        if temp_sysfs_path is None:
+            raise ValueError("no sysfs cpu temperature sensor found")
+        log(f"using cpu temperature sensor at {temp_sysfs_path}")
 except ValueError as ex:
     log(f"failed to parse config entry: '{str(ex)}'")
     exit(1)
@@ -73,79 +203,339 @@ except Exception as ex:
     raise ex
 
 
-# returns the time in seconds for which it successfully ran
-def report_cpu_temps() -> float:
-    start = datetime.datetime.now()
-    last_report_time = start
+# influxdb v2 write endpoint, the request line and headers never change
+write_path = influx_url.path.rstrip("/") + "/api/v2/write?" + urlencode({
+    "org": influx_org,
+    "bucket": influx_bucket,
+    "precision": "ns"
+})
+write_headers = {
+    "Authorization": f"Token {influx_token}",
+    "Content-Type": "text/plain; charset=utf-8"
+}
+# all requests on a connection go through this single thread, so a flush
+# on shutdown can't interleave with a write that is still in flight
+write_executor = ThreadPoolExecutor(max_workers=1)
+
+
+# keep our own scheduling noise away from the cores we're measuring
+if pin_cpu is not None:
+    try:
+        os.sched_setaffinity(0, {pin_cpu})
+    except OSError as ex:
+        log(f"failed to pin process to cpu {pin_cpu}: {str(ex)}")
+if nice_level is not None:
+    try:
+        os.setpriority(os.PRIO_PROCESS, 0, nice_level)
+    except OSError as ex:
+        log(f"failed to set nice level {nice_level}: {str(ex)}")
+
+
+# measurement, tags and field never change, so the line protocol up to the
+# field value is only built (and utf-8 encoded) once. write_body joins the
+# encoded lines directly into the request body
+lp_prefix = lp_escape(influx_measurement, ", ")
+if influx_server_name_tag is not None:
+    lp_prefix += (
+        f",{lp_escape(influx_server_name_tag)}={lp_escape(server_name)}"
+    )
+lp_prefix = f"{lp_prefix} {lp_escape(influx_field)}=".encode()
+
+
+# kept open across reads, sysfs attributes can be re-read using pread at 0
+temp_fd = None
+# fixed size read target, filled by a single preadv per sample. parsing
+# still slices it, so that allocates one small object per sample
+temp_buf = bytearray(16)
+
+
+def close_temp_fd():
+    global temp_fd
+    if temp_fd is not None:
+        os.close(temp_fd)
+        temp_fd = None
+
+
+def read_sysfs_temp() -> float:
+    global temp_fd
+    if temp_fd is None:
+        temp_fd = os.open(temp_sysfs_path, os.O_RDONLY)
     try:
-        # connect to influxdb
-        influx_client = InfluxDBClient(
-            url=influx_url,
-            org=influx_org,
-            token=influx_token,
-            bucket=influx_bucket
+        n = os.preadv(temp_fd, (temp_buf,), 0)
+    except OSError:
+        # the sensor might have been removed and re-added, reopen once
+        close_temp_fd()
+        temp_fd = os.open(temp_sysfs_path, os.O_RDONLY)
+        n = os.preadv(temp_fd, (temp_buf,), 0)
+    # sysfs reports millidegrees celsius
+    return int(temp_buf[:n]) / 1000.0
+
+
+sensors_env = dict(os.environ, LC_ALL="C")
+
+# after a failed read, the sensor is left alone until sensor_fail_until
+# (monotonic time), so e.g. a missing `sensors` isn't respawned every interval
+sensor_fail_count = 0
+sensor_fail_until = 0.0
+
+
+async def read_cpu_temp() -> float:
+    if temp_sysfs_path is not None:
+        # a sysfs read doesn't block long enough to warrant an executor
+        return read_sysfs_temp()
+    # no shell in between, and a C locale to avoid locale dependent formatting
+    proc = await asyncio.create_subprocess_exec(
+        "sensors", "-j",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+        env=sensors_env
+    )
+    stdout, _ = await proc.communicate()
+    # sensors emits strict json, so the much faster stdlib parser suffices
+    result = json.loads(stdout)
+    for apc in temp_access_path:
+        result = result[apc]
+    return float(result)
+
+
+class InfluxWriteError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"http status {status}: {message}")
+        self.status = status
+
+
+def new_connection():
+    # connects lazily on the first request and stays open (keep-alive)
+    if influx_url.scheme == "https":
+        return http.client.HTTPSConnection(
+            influx_url.hostname, influx_port, timeout=http_timeout
         )
-        write_api = influx_client.write_api(write_options=SYNCHRONOUS)
-    except (InfluxDBError, HTTPError) as ex:
-        log(f"influxdb connection failed: {str(ex)}")
-        return (last_report_time - start).total_seconds()
+    return http.client.HTTPConnection(
+        influx_url.hostname, influx_port, timeout=http_timeout
+    )
 
-    while True:
+
+# runs on the write_executor thread
+def post_lines(conn, body):
+    try:
         try:
-            # aquire data
-            cmd = 'sensors -j'
-            output = subprocess.run(cmd, shell=True, capture_output=True)
-            stdout = output.stdout.decode("utf-8")
-            result = json5.loads(stdout)
-            for apc in temp_access_path:
-                result = result[apc]
-            result = float(result)
-        except (OSError, KeyError, ValueError) as ex:
-            log(f"failed to read sensor data: {str(ex)}")
-            return (last_report_time - start).total_seconds()
-
-        p = Point(influx_measurement).field(influx_field, result)
-        if influx_server_name_tag is not None:
-            p = p.tag(influx_server_name_tag, server_name)
-
-        # wait for the current interval to elapse
-        if last_report_time != start:
-            sleep_time = (
-                interval -
-                (datetime.datetime.now() - last_report_time).total_seconds()
+            conn.request("POST", write_path, body=body, headers=write_headers)
+            response = conn.getresponse()
+        except (http.client.BadStatusLine, ConnectionError):
+            # the server closed the idle keep-alive connection, reopen once
+            conn.close()
+            conn.request("POST", write_path, body=body, headers=write_headers)
+            response = conn.getresponse()
+        message = response.read()
+    except (OSError, http.client.HTTPException):
+        # http.client reconnects on the next request after close()
+        conn.close()
+        raise
+    if response.status >= 300:
+        raise InfluxWriteError(
+            response.status, message.decode("utf-8", errors="replace")
+        )
+
+
+async def write_body(conn, lines):
+    await asyncio.get_running_loop().run_in_executor(
+        write_executor, post_lines, conn, b"\n".join(lines)
+    )
+    if log_success:
+        server_name_ref = (
+            "" if influx_server_name_tag is None
+            else f"'{server_name}' "
+        )
+        log(f"submitted {len(lines)} {server_name_ref}CPU temp samples")
+
+
+# writes queued lines in batches until a write fails with an error that
+# retrying on the same connection can't fix (redirect, bad token, missing
+# bucket, ...).
+# batch is only cleared once written, so it survives reconnects
+async def write_lines(conn, write_queue, batch):
+    while True:
+        if not batch:
+            batch.append(await write_queue.get())
+        batch_deadline = time.monotonic() + max_batch_age
+        while len(batch) < batch_size:
+            timeout = batch_deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(
+                    await asyncio.wait_for(write_queue.get(), timeout)
+                )
+            except asyncio.TimeoutError:
+                break
+        retries = 0
+        while True:
+            try:
+                await write_body(conn, batch)
+                break
+            except (
+                InfluxWriteError, OSError, http.client.HTTPException
+            ) as ex:
+                log(f"failed to write sensor data to influxdb: {str(ex)}")
+                status = getattr(ex, "status", None)
+                if status is not None and (
+                    300 <= status < 400 or status in (401, 403, 404)
+                ):
+                    # redirect (wrong influx_url) or bad credentials / bucket,
+                    # keep the batch and reconnect with backoff
+                    raise
+                transient = (
+                    status is None or status in (408, 429) or status >= 500
+                )
+                if not transient:
+                    # any other 4xx: the data itself was rejected, retrying
+                    # won't help
+                    break
+            # transient error, retry on the same connection, keeping it
+            # (and its tls session) alive
+            await asyncio.sleep(min(2 ** retries, back_off_max_interval))
+            retries += 1
+        batch.clear()
+
+
+async def flush_lines(conn, write_queue, batch):
+    while not write_queue.empty():
+        batch.append(write_queue.get_nowait())
+    if batch:
+        await write_body(conn, batch)
+        batch.clear()
+
+
+# returns the time in seconds for which it successfully ran
+async def report_cpu_temps(write_queue, batch) -> float:
+    global sensor_fail_count, sensor_fail_until
+    start = time.monotonic()
+    last_report_time = start
+    conn = new_connection()
+    # network i/o happens in a separate task, so a slow influxdb doesn't
+    # delay sampling
+    writer = asyncio.create_task(write_lines(conn, write_queue, batch))
+    try:
+        # absolute deadline of the next sample, so write latency doesn't
+        # accumulate as drift of the sampling period
+        next_deadline = max(start, sensor_fail_until)
+        current_interval = interval
+        last_written = None
+        idle_skips = 0
+        while True:
+            # wait for the current interval to elapse
+            now = time.monotonic()
+            if now < next_deadline:
+                await asyncio.sleep(next_deadline - now)
+                # we woke up at the deadline, reuse it instead of
+                # reading the clock again
+                now = next_deadline
+            elif now - next_deadline > current_interval:
+                # we fell behind by more than an interval (e.g. after a
+                # suspend), don't try to catch up on the missed samples
+                next_deadline = now
+            if writer.done():
+                # the writer hit an error that requires reconnecting
+                return last_report_time - start
+            try:
+                # aquire data
+                result = await read_cpu_temp()
+            except (OSError, KeyError, ValueError) as ex:
+                # capped, so the power below can't overflow a float after
+                # a long enough outage
+                sensor_fail_count = min(sensor_fail_count + 1, 30)
+                retry_time = min(
+                    back_off_max_interval, interval * 2 ** sensor_fail_count
+                )
+                log(
+                    f"failed to read sensor data: {str(ex)}, "
+                    f"retrying in {retry_time:.3f} seconds"
+                )
+                sensor_fail_until = time.monotonic() + retry_time
+                next_deadline = sensor_fail_until
+                continue
+            sensor_fail_count = 0
+            last_report_time = now
+
+            stable = (
+                last_written is not None
+                and abs(result - last_written) < min_delta_c
             )
-            time.sleep(max(0, sleep_time))
-        last_report_time = datetime.datetime.now()
+            if stable:
+                current_interval = min(
+                    current_interval * idle_backoff_factor,
+                    idle_backoff_max_interval
+                )
+            else:
+                current_interval = interval
+            next_deadline += current_interval
+            # skip stable samples, but still submit one every
+            # max_idle_writes skips as a heartbeat
+            if stable and idle_skips < max_idle_writes:
+                idle_skips += 1
+                continue
+            idle_skips = 0
+            last_written = result
+            try:
+                # queue for writing to influx db
+                write_queue.put_nowait(
+                    lp_prefix + f"{result} {time.time_ns()}".encode("ascii")
+                )
+            except asyncio.QueueFull:
+                log("write queue is full, dropping sensor data")
+    finally:
+        close_temp_fd()
+        writer.cancel()
         try:
-            # write to influx db
-            write_api.write(bucket=influx_bucket, record=p)
-        except (InfluxDBError, HTTPError) as ex:
-            log(f"failed to write sensor data to influxdb: {str(ex)}")
-            return (last_report_time - start).total_seconds()
-        if log_success:
-            server_name_ref = (
-                "" if influx_server_name_tag is None
-                else f"'{server_name}' "
-            )
-            log(f"submitted {server_name_ref}CPU temp: {result} celsius")
+            await writer
+        except asyncio.CancelledError:
+            # submit whatever is pending before disconnecting
+            try:
+                await asyncio.wait_for(
+                    flush_lines(conn, write_queue, batch), flush_timeout
+                )
+            except (
+                InfluxWriteError, OSError, http.client.HTTPException,
+                asyncio.TimeoutError
+            ) as ex:
+                log(f"failed to flush sensor data to influxdb: {str(ex)}")
+        except InfluxWriteError:
+            pass
+        write_executor.submit(conn.close)
 
 
-try:
+async def main():
     log(f"{app_name} started")
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGHUP, on_sighup)
+    # systemd stops services with SIGTERM. cancelling takes the same path as
+    # ctrl-c, which flushes pending samples before exiting
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    # kept across reconnects, so samples taken during an outage aren't lost
+    write_queue = asyncio.Queue(maxsize=max_queued_points)
+    batch = []
     # try forever, increase backoff time exponentially in case of failure
     backoff_skip = 2.0
     max_backoff_skip = back_off_max_interval / max(interval, 0.1)
-    while True:
-        runtime = report_cpu_temps()
-        if runtime > backoff_skip * interval:
-            backoff_skip = 2.0
-        elif backoff_skip < max_backoff_skip:
-            max_backoff_skip = backoff_skip ** random.uniform(1, 2)
-            if backoff_skip > max_backoff_skip:
-                backoff_skip = max_backoff_skip
-        bt = backoff_skip * interval
-        log(f"backoff time: {bt:.3f} seconds")
-        time.sleep(bt)
+    try:
+        while True:
+            runtime = await report_cpu_temps(write_queue, batch)
+            if runtime > backoff_skip * interval:
+                backoff_skip = 2.0
+            elif backoff_skip < max_backoff_skip:
+                backoff_skip = min(
+                    max_backoff_skip, backoff_skip ** (rng.random() + 1.0)
+                )
+            # +-10% jitter, so multiple hosts don't reconnect in lockstep
+            bt = backoff_skip * interval * (0.9 + 0.2 * rng.random())
+            log(f"backoff time: {bt:.3f} seconds")
+            await asyncio.sleep(bt)
+    except asyncio.CancelledError:
+        log(f"{app_name} stopped")
+
+
+try:
+    asyncio.run(main())
 except Exception as ex:
     if log_file is not None:
         log(f"{app_name} crashed: {str(ex)}")